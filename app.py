@@ -1,4 +1,20 @@
+import argparse
+import csv
+import functools
+import json
+import os
+import queue
+import re
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
 import streamlit as st
+from streamlit.logger import set_log_level
+from scipy import sparse
 
 # ---------------------------------------------------------
 # 1. 석곡 의감중마 대사전 DB (Total 200+ Formulas)
@@ -183,43 +199,1491 @@ FORMULA_BOOK = {
 }
 
 # ---------------------------------------------------------
-# 2. 메인 로직 (계층형 탐색 & 전체 보기)
+# 2. 통합 처방 저장소 (FORMULA_BOOK + formulas.csv)
+#    * 두 출처를 하나의 열 지향 표(pandas)로 합치고 출처(source)를 보존
+#    * 처방명 정규화 후 같은 이름은 변형(variant)으로 기록
+#    * 출처 파일의 mtime 이 바뀐 쪽만 다시 읽고 파싱 (st.cache_resource)
 # ---------------------------------------------------------
-def main():
-    st.set_page_config(page_title="의감중마 처방 대사전", layout="wide")
-    
-    st.title("📚 [석곡 의감중마] 처방 대사전 (Full Ver.)")
-    st.caption("의감중마의 모든 항목과 처방을 목차 순서대로 찾고 비교합니다.")
-    st.markdown("---")
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FORMULAS_CSV = os.environ.get("HANBANG_FORMULAS_CSV", os.path.join(BASE_DIR, "formulas.csv"))
+# 설정하면 미리 컴파일한 SQLite 파일을 읽는다 (python -m app compile-db 로 생성)
+FORMULAS_DB = os.environ.get("HANBANG_DB")
+DEFAULT_DB = os.path.join(BASE_DIR, "hanbang.db")
+
+BOOK_SOURCE = "의감중마"
+CSV_COLUMNS = {"처방명": "name", "약어": "abbr", "출처": "source", "구성약재": "rx", "효능": "info"}
+CSV_MAIN_CAT = f"{len(FORMULA_BOOK) + 1}. 추가 처방 (formulas.csv)"
+FORMULA_COLUMNS = ["name", "abbr", "source", "main_cat", "sub_cat", "rx", "info"]
+
+RX_ITEM_RE = re.compile(r"^(?P<herb>.+?)\s*(?P<amount>\d+(?:\.\d+)?)\s*(?P<unit>\D*)$")
+NAME_NOTE_RE = re.compile(r"\s*[\[(].*?[\])]")
+
+DON_G = 4.0  # 1돈=4g
+
+# 같은 약재의 다른 표기 -> FORMULA_BOOK 표기
+HERB_ALIASES = {"대추": "대조"}
+
+
+def normalize_name(name):
+    """'이조전 [석곡]' -> '이조전' (괄호 주석과 공백 제거)"""
+    return NAME_NOTE_RE.sub("", name).replace(" ", "")
+
+
+def explode_rx(rx):
+    """rx 문자열 Series -> 약재 단위 long 표 (id, herb, grams)
+
+    id 는 입력 Series 의 index. g 이외의 단위(예: '오미자 15알')는 grams 가 NaN.
+    """
+    items = rx.str.split(",").explode().str.strip()
+    items = items[items.notna() & (items != "")]
+    parts = items.str.extract(RX_ITEM_RE.pattern)
+    herbs = parts["herb"].fillna(items).replace(HERB_ALIASES)
+    grams = pd.to_numeric(parts["amount"]).where(parts["unit"].str.strip() == "g")
+    return pd.DataFrame({
+        "id": items.index.to_numpy(dtype="int64"),
+        "herb": herbs.to_numpy(dtype=object),
+        "grams": grams.to_numpy(dtype="float32"),
+    })
+
+
+def iter_formulas(book=FORMULA_BOOK):
+    """(대분류, 소분류, 처방) 을 목차 순서대로 나열"""
+    for main_cat, sub_cats in book.items():
+        for sub_cat, formulas in sub_cats.items():
+            for formula in formulas:
+                yield main_cat, sub_cat, formula
+
+
+def book_frame(book=FORMULA_BOOK):
+    rows = [
+        {"name": f["name"], "abbr": "", "source": BOOK_SOURCE, "main_cat": main_cat, "sub_cat": sub_cat,
+         "rx": f["rx"], "info": f["info"]}
+        for main_cat, sub_cat, f in iter_formulas(book)
+    ]
+    return pd.DataFrame(rows, columns=FORMULA_COLUMNS)
+
+
+def csv_frame(path=FORMULAS_CSV):
+    df = pd.read_csv(path, dtype=str, keep_default_na=False).rename(columns=CSV_COLUMNS)
+    df["main_cat"] = CSV_MAIN_CAT
+    df["sub_cat"] = df["source"].replace("", "기타")
+    return df[FORMULA_COLUMNS]
+
+
+class FormulaStore:
+    """처방 표(formulas) + 약재 long 표(herbs). 처방 id = formulas 의 행 번호"""
+
+    # 조회 객체 종류. 스트림릿은 재실행마다 모듈을 다시 실행해 클래스를 새로 만들므로,
+    # 캐시된 객체를 isinstance 로 가리면 어긋난다 - 이 표지로 구분한다.
+    backend = "memory"
+
+    def __init__(self, formulas, herbs, version):
+        self.formulas = formulas
+        self.herbs = herbs
+        self.version = version
+
+        # herbs 는 id 순으로 정렬돼 있다: 처방 i 의 약재 = herbs[offsets[i]:offsets[i + 1]]
+        self._herb_offsets = np.searchsorted(herbs["id"].to_numpy(), np.arange(len(formulas) + 1))
+        self._herb_names = herbs["herb"].cat.categories.to_numpy(dtype=object)[herbs["herb"].cat.codes.to_numpy()]
+        self._herb_grams = herbs["grams"].to_numpy()
+
+        # 목차: 대분류 -> [소분류], (대분류, 소분류) -> 처방 id 배열 (등장 순서 유지)
+        self.categories = {}
+        for key, ids in formulas.groupby(["main_cat", "sub_cat"], sort=False, observed=True).indices.items():
+            self.categories[key] = ids
+        self.toc = {}
+        for main_cat, sub_cat in formulas[["main_cat", "sub_cat"]].drop_duplicates().itertuples(index=False):
+            self.toc.setdefault(main_cat, []).append(sub_cat)
+
+        # 처방명(정규화) -> 대표 처방 id, 약어 -> 그 약어를 가진 처방 id
+        abbr = formulas[formulas["abbr"] != ""]
+        abbr_keys = abbr["abbr"].map(normalize_name).to_numpy()
+        self.name_ids = pd.Series(formulas["canonical_id"].to_numpy(), index=formulas["norm_name"].to_numpy())
+        self.name_ids = self.name_ids[~self.name_ids.index.duplicated()]
+        self.abbr_ids = pd.Series(abbr["id"].to_numpy(), index=abbr_keys)
+        self.abbr_ids = self.abbr_ids[~self.abbr_ids.index.duplicated()]
+        # (처방명 또는 약어, 출처) -> 처방 id: 같은 이름의 변형 중 출처로 고를 때
+        self.source_ids = pd.Series(
+            np.concatenate([formulas["id"].to_numpy(), abbr["id"].to_numpy()]),
+            index=pd.MultiIndex.from_arrays([
+                np.concatenate([formulas["norm_name"].to_numpy(dtype=object), abbr_keys]),
+                np.concatenate([formulas["source"].astype(str).to_numpy(dtype=object),
+                                abbr["source"].astype(str).to_numpy(dtype=object)]),
+            ]),
+        )
+        self.source_ids = self.source_ids[~self.source_ids.index.duplicated()]
+        # 같은 이름의 변형들: canonical_id 순으로 정렬한 id 배열에서 구간 조회
+        self._canonical = formulas["canonical_id"].to_numpy()
+        self._variant_order = np.argsort(self._canonical, kind="stable")
+        self._variant_keys = self._canonical[self._variant_order]
+
+    def __len__(self):
+        return len(self.formulas)
+
+    def rows(self, ids):
+        return self.formulas.iloc[list(ids)].to_dict("records")
+
+    def category_ids(self, main_cat, sub_cat):
+        return self.categories[(main_cat, sub_cat)]
+
+    def formula_herbs(self, formula_id):
+        """[(약재, g 또는 None), ...] - 파싱된 표에서 바로 읽는다"""
+        lo, hi = self._herb_offsets[formula_id], self._herb_offsets[formula_id + 1]
+        return [(herb, None if np.isnan(g) else float(g))
+                for herb, g in zip(self._herb_names[lo:hi], self._herb_grams[lo:hi].tolist())]
+
+    def herb_rows(self, ids):
+        """처방 id 들의 약재 long 표 (id, herb, grams)"""
+        return self.herbs[self.herbs["id"].isin(ids)]
+
+    def variant_ids(self, formula_id):
+        """formula_id 와 이름(정규화)이 같은 처방 id 들 (id 순, 자기 자신 포함)"""
+        canonical = self._canonical[formula_id]
+        lo, hi = np.searchsorted(self._variant_keys, [canonical, canonical + 1])
+        return self._variant_order[lo:hi].tolist()
+
+    def resolve(self, names, sources=None):
+        """처방명 또는 약어 Series -> 처방 id Series (없으면 NaN)
+
+        처방명은 대표 처방(가장 앞의 변형), 약어는 그 약어를 가진 처방으로 찾는다.
+        sources(출처 Series)가 있는 행은 그 출처의 처방만 찾는다 (예: 계지탕 + JKMED).
+        """
+        keys = names.astype(str).map(normalize_name)
+        ids = keys.map(self.name_ids).fillna(keys.map(self.abbr_ids))
+        if sources is None:
+            return ids
+        sources = sources.fillna("").astype(str).str.strip()
+        by_source = pd.Series(self.source_ids.reindex(pd.MultiIndex.from_arrays([keys, sources])).to_numpy(),
+                              index=names.index)
+        return ids.where(sources == "", by_source)
+
+    @classmethod
+    def merge(cls, parts, version):
+        """[(formulas, herbs), ...] 를 이어 붙이고 id 를 다시 매긴다"""
+        frames, herb_frames, offset = [], [], 0
+        for formulas, herbs in parts:
+            frames.append(formulas)
+            herb_frames.append(herbs.assign(id=herbs["id"] + offset))
+            offset += len(formulas)
+
+        formulas = pd.concat(frames, ignore_index=True)
+        formulas.insert(0, "id", formulas.index.to_numpy(dtype="int32"))
+        formulas["norm_name"] = formulas["name"].map(normalize_name)
+        groups = formulas.groupby("norm_name", sort=False)
+        formulas["canonical_id"] = groups["id"].transform("min").astype("int32")
+        formulas["variant_no"] = groups.cumcount().astype("int16")
+        formulas["n_variants"] = groups["id"].transform("size").astype("int16")
+        return cls.from_frames(formulas, pd.concat(herb_frames, ignore_index=True), version)
+
+    @classmethod
+    def from_frames(cls, formulas, herbs, version):
+        """열 자료형을 압축해서 저장소를 만든다"""
+        for col in ("source", "main_cat", "sub_cat"):
+            formulas[col] = formulas[col].astype("category")
+        herbs = herbs.sort_values("id", kind="stable", ignore_index=True)
+        herbs["id"] = herbs["id"].astype("int32")
+        herbs["herb"] = herbs["herb"].astype("category")
+        herbs["grams"] = herbs["grams"].astype("float32")
+        return cls(formulas, herbs, version)
+
+
+def _parse_frame(formulas):
+    formulas = formulas.reset_index(drop=True)
+    return formulas, explode_rx(formulas["rx"])
+
+
+# mtime 인자는 캐시 키 역할만 한다 (바뀌면 해당 출처만 다시 읽음)
+@st.cache_resource(max_entries=1)
+def _load_book(mtime):
+    return _parse_frame(book_frame())
+
+
+@st.cache_resource(max_entries=1)
+def _load_csv(path, mtime):
+    if mtime is None:
+        return _parse_frame(pd.DataFrame(columns=FORMULA_COLUMNS))
+    return _parse_frame(csv_frame(path))
+
+
+@st.cache_resource(max_entries=1)
+def _merge_sources(book_mtime, csv_path, csv_mtime):
+    parts = [_load_book(book_mtime), _load_csv(csv_path, csv_mtime)]
+    return FormulaStore.merge(parts, version=(book_mtime, csv_path, csv_mtime))
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def load_source_store():
+    return _merge_sources(_mtime(__file__), FORMULAS_CSV, _mtime(FORMULAS_CSV))
+
+
+def load_store():
+    db_mtime = _mtime(FORMULAS_DB) if FORMULAS_DB else None
+    if db_mtime is not None:
+        return _load_db_store(FORMULAS_DB, db_mtime)
+    return load_source_store()
+
+
+# ---------------------------------------------------------
+# 3. 약재 역색인
+#    * 약재 -> 처방 역색인으로 포함/제외 조합을 집합 연산으로 조회
+# ---------------------------------------------------------
+class HerbIndex:
+    """약재 -> 처방 id 역색인"""
+
+    def __init__(self, store):
+        self.store = store
+        self.all_ids = frozenset(range(len(store)))
+
+        ids = store.herbs["id"].to_numpy()
+        positions = store.herbs.groupby("herb", observed=True).indices
+        self.postings = {herb: frozenset(ids[pos].tolist()) for herb, pos in positions.items()}
+
+        # 많이 쓰이는 약재부터 (선택 위젯용)
+        self.herbs = sorted(self.postings, key=lambda h: (-len(self.postings[h]), h))
+
+    def query(self, include=(), exclude=()):
+        """include 약재를 모두 포함하고 exclude 약재는 하나도 없는 처방 id 목록"""
+        empty = frozenset()
+        # 가장 희귀한 약재부터 교집합을 좁혀 나간다
+        include = sorted(set(include), key=lambda h: len(self.postings.get(h, empty)))
+        ids = self.postings.get(include[0], empty) if include else self.all_ids
+        for herb in include[1:]:
+            if not ids:
+                break
+            ids = ids & self.postings.get(herb, empty)
+        for herb in exclude:
+            ids = ids - self.postings.get(herb, empty)
+        return sorted(ids)
+
+
+@st.cache_resource(max_entries=1)
+def _build_herb_index(_store, version):
+    return HerbIndex(_store)
+
+
+def load_herb_index():
+    store = load_store()
+    return _build_herb_index(store, store.version)
+
+
+# ---------------------------------------------------------
+# 4. 통합 검색 (처방명 / 약어 / 적응증 / 약재, 초성)
+#    * 필드별 n-gram -> 처방 id 배열 역색인을 한 번만 만들어 둔다
+#    * 질의마다 n-gram 적중 수를 bincount 로 세어 점수화 (오타 허용)
+#    * 가산점 상한 순으로 필요한 만큼(보여줄 페이지까지)만 부분 문자열 검증
+# ---------------------------------------------------------
+CHOSEONG = "ㄱㄲㄴㄷㄸㄹㅁㅂㅃㅅㅆㅇㅈㅉㅊㅋㅌㅍㅎ"
+SEARCH_TEXT_RE = re.compile(r"[^0-9a-z가-힣ㄱ-ㅎ一-鿿]+")
+RX_DOSE_RE = re.compile(r"\d+(?:\.\d+)?\s*[^\s,]*")
+CITATION_RE = re.compile(r"\[[^\]]*\]")
+
+# (필드, 가중치, n-gram 크기) - 짧은 필드는 1-gram 도 색인해 한 글자 질의와 오타를 받는다
+SEARCH_FIELDS = (("name", 10.0, (1, 2)), ("abbr", 8.0, (1, 2)), ("info", 3.0, (2,)), ("rx", 2.0, (2,)))
+CHOSEONG_FIELDS = (("choseong", 10.0, (1, 2)),)
+SEARCH_MIN_RATIO = 0.5
+SEARCH_RESULT_LIMIT = 500  # 통합 검색 화면에서 페이지로 나눠 보여줄 최대 결과 수
+SEARCH_COLUMNS = [field for field, _, _ in SEARCH_FIELDS + CHOSEONG_FIELDS]
+SEARCH_CACHE_SIZE = 32  # 최근 질의의 후보 점수를 기억해 페이지를 넘길 때 다시 세지 않는다
+
+
+def normalize_text(text):
+    """소문자화 후 공백/문장부호 제거 ('왕래 한열,' -> '왕래한열')"""
+    return SEARCH_TEXT_RE.sub("", text.lower())
 
+
+def to_choseong(text):
+    """'소시호탕' -> 'ㅅㅅㅎㅌ' (한글 음절이 아닌 글자는 그대로)"""
+    out = []
+    for ch in text:
+        code = ord(ch) - 0xAC00
+        out.append(CHOSEONG[code // 588] if 0 <= code < 11172 else ch)
+    return "".join(out)
+
+
+def is_choseong_query(text):
+    return bool(text) and all(ch in CHOSEONG for ch in text)
+
+
+def ngrams(text, sizes):
+    return {text[i:i + n] for n in sizes for i in range(len(text) - n + 1)}
+
+
+def start_gram(text, sizes):
+    """텍스트 맨 앞 n-gram 의 색인 키 ('^' 는 정규화된 텍스트에 나오지 않는다). 너무 짧으면 None"""
+    fits = [n for n in sizes if n <= len(text)]
+    return "^" + text[:max(fits)] if fits else None
+
+
+def search_texts(formulas):
+    """검색 필드별 정규화 텍스트 Series (name, abbr, info, rx, choseong)"""
+    # 용량('12g')과 출전 표기('[의감중마1]')는 색인하지 않는다
+    rx_herbs = formulas["rx"].str.replace(RX_DOSE_RE.pattern, "", regex=True)
+    info = formulas["info"].str.replace(CITATION_RE.pattern, "", regex=True)
+    texts = {
+        "name": formulas["name"].map(normalize_text),
+        "abbr": formulas["abbr"].map(normalize_text),
+        "info": info.map(normalize_text),
+        "rx": rx_herbs.map(normalize_text),
+    }
+    # 약어는 '|' 로 구분해 처방명 초성과 이어지지 않게 한다
+    texts["choseong"] = (texts["name"] + "|" + texts["abbr"]).map(to_choseong)
+    return texts
+
+
+def build_postings(series, sizes):
+    """정규화 텍스트 Series -> {n-gram: 처방 id 배열(int32)}
+
+    맨 앞 n-gram 도 '^' 를 붙여 따로 색인해 '질의로 시작하는 필드'의 가산점 상한을 정확히 잡는다.
+    """
+    grams = series.map(lambda t: ngrams(t, sizes) | {"^" + t[:n] for n in sizes if n <= len(t)})
+    grams = grams.explode().dropna()
+    ids = grams.index.to_numpy(dtype="int32")
+    positions = pd.DataFrame({"gram": grams.to_numpy(dtype=object)}).groupby("gram", sort=False).indices
+    return {gram: ids[pos] for gram, pos in positions.items()}
+
+
+class NgramSearch:
+    """n-gram 점수 + 부분 문자열 가산점 순위 검색 (SearchIndex 와 FormulaDB 가 같은 순위를 낸다)
+
+    점수 = 필드별 n-gram 적중 비율² x 가중치 + 질의 전체가 들어 있는 필드의 가산점(맨 앞이면 2배).
+    가산점은 n-gram 이 모두 맞은 필드에서만 나올 수 있으므로 그 상한으로 후보를 정렬해 두고,
+    상한이 지금의 limit 번째 점수보다 낮아질 때까지만 부분 문자열을 확인한다 (페이지 크기만큼만 검증).
+
+    하위 클래스는 __len__, _hits(필드, n-gram 목록), _field_texts(검색 필드, ids) 를 제공한다.
+    """
+
+    def __init__(self):
+        self._candidates = functools.lru_cache(maxsize=SEARCH_CACHE_SIZE)(self._score)
+
+    def _score(self, q):
+        """(검색 필드, 후보 id 오름차순, n-gram 점수, 가산점 포함 점수 상한)"""
+        fields = CHOSEONG_FIELDS if is_choseong_query(q) else SEARCH_FIELDS
+        n = len(self)
+        counts = []
+        matched = np.zeros(n, dtype=bool)
+        for field, _, sizes in fields:
+            grams = ngrams(q, sizes)
+            hits = self._hits(field, grams) if grams else []
+            count = np.bincount(np.concatenate(hits), minlength=n) if hits else None
+            if count is not None:
+                matched |= count >= SEARCH_MIN_RATIO * len(grams)
+            counts.append((count, len(grams)))
+
+        # 점수와 상한은 후보에서만 계산한다
+        candidates = np.flatnonzero(matched)
+        score = np.zeros(len(candidates))
+        bonus = np.zeros(len(candidates))
+        for (field, weight, sizes), (count, n_grams) in zip(fields, counts):
+            if not n_grams:  # 질의가 n-gram 보다 짧으면 점수는 없어도 가산점은 받을 수 있다
+                bonus += 2.0 * weight
+                continue
+            if count is None:
+                continue
+            ratio = count[candidates] / n_grams
+            score += weight * ratio * ratio
+            full = ratio >= 1.0  # 질의 전체가 들어 있을 수 있는 필드
+            at_start = np.zeros(n, dtype=bool)
+            for ids in self._hits(field, [start_gram(q, sizes)]):
+                at_start[ids] = True
+            bonus += weight * full * (1.0 + at_start[candidates])
+        return fields, candidates, score, score + bonus
+
+    @staticmethod
+    def _by_bound(bound, size):
+        """상한 내림차순(같으면 id 순) 위치를 size 개씩 - 앞쪽 몇 묶음만 정렬하고 나머지는 더 필요할 때 정렬"""
+        k = size * 4
+        head = np.arange(len(bound))
+        rest = head[:0]
+        if len(bound) > k:
+            cut = -np.partition(-bound, k - 1)[k - 1]  # k 번째로 큰 상한 (같은 값이 많아도 빠른 방향)
+            head, rest = np.flatnonzero(bound >= cut), np.flatnonzero(bound < cut)
+        for part in (head, rest):
+            order = part[np.argsort(-bound[part], kind="stable")]  # 후보가 id 순이라 같은 상한은 id 순
+            for start in range(0, len(order), size):
+                yield order[start:start + size]
+
+    def count(self, query):
+        """검색 결과 수 (부분 문자열 확인 없이 n-gram 점수만으로 센다)"""
+        q = normalize_text(query)
+        return len(self._candidates(q)[1]) if q else 0
+
+    def search(self, query, limit=30):
+        """[(처방 id, 점수), ...] 점수 내림차순 (같은 점수는 id 순) - limit 이 작을수록 빠르다"""
+        q = normalize_text(query)
+        if not q or limit < 1:
+            return []
+        fields, candidates, score, bound = self._candidates(q)
+        results = []
+        for chunk in self._by_bound(bound, limit):
+            if len(results) >= limit:
+                results.sort(key=lambda r: (-r[1], r[0]))
+                del results[limit:]
+                last_id, last_score = results[-1]
+                # 남은 후보는 상한 내림차순·id 오름차순이라 여기서 멈춰도 순위가 같다
+                top, top_id = bound[chunk[0]], candidates[chunk[0]]
+                if top < last_score or (top == last_score and top_id > last_id):
+                    break
+            ids = candidates[chunk].tolist()
+            for i, s, texts in zip(ids, score[chunk].tolist(), self._field_texts(fields, ids)):
+                extra = 0.0  # 상한과 같은 순서로 더해 같은 점수는 같은 부동소수가 되게 한다
+                for (_, weight, _), text in zip(fields, texts):
+                    pos = text.find(q)
+                    if pos >= 0:
+                        extra += weight * (2.0 if pos == 0 else 1.0)
+                results.append((i, s + extra))
+        results.sort(key=lambda r: (-r[1], r[0]))
+        return results[:limit]
+
+
+class SearchIndex(NgramSearch):
+    """필드별 n-gram 역색인 (메모리)"""
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+        texts = search_texts(store.formulas)
+        self._postings = {
+            field: build_postings(texts[field], sizes) for field, _, sizes in SEARCH_FIELDS + CHOSEONG_FIELDS
+        }
+        self._texts = {field: texts[field].tolist() for field in SEARCH_COLUMNS}
+
+    def __len__(self):
+        return len(self.store)
+
+    def _hits(self, field, grams):
+        postings = self._postings[field]
+        return [postings[g] for g in grams if g in postings]
+
+    def _field_texts(self, fields, ids):
+        """ids 순서대로 [(필드별 텍스트, ...), ...]"""
+        columns = [self._texts[field] for field, _, _ in fields]
+        return [tuple(col[i] for col in columns) for i in ids]
+
+
+@st.cache_resource(max_entries=1)
+def _build_search_index(_store, version):
+    return SearchIndex(_store)
+
+
+def load_search_index():
+    catalog = load_catalog()
+    if catalog.backend == "db":  # FormulaDB 는 컴파일한 n-gram 역색인으로 바로 검색
+        return catalog
+    return _build_search_index(catalog, catalog.version)
+
+
+# ---------------------------------------------------------
+# 5. 비슷한 처방 찾기 (처방 x 약재 용량 희소 행렬)
+#    * 코사인: 행 정규화 행렬과 블록 행(dense)의 곱 (희소 x dense)
+#    * 가중 자카드: sum(min) / sum(max), 약재 열(CSC)별로 min 을 누적
+#    * 이웃 목록은 한 번 계산해 두고 화면에서는 조회만 한다
+# ---------------------------------------------------------
+SIMILARITY_METRICS = {"cosine": "코사인 (약재·용량)", "jaccard": "가중 자카드"}
+NEIGHBOR_K = 10
+NEIGHBOR_PRECOMPUTE_LIMIT = 5_000  # 이보다 큰 코퍼스는 처방별로 요청 시 계산 후 보관
+NEIGHBOR_BLOCK_CELLS = 1 << 22  # 코사인 블록 하나의 dense 크기 (행 x 처방 수)
+
+
+def _top_k(sims, k):
+    """행마다 점수 상위 k 개의 (열 번호, 점수) - 점수 내림차순"""
+    k = min(k, sims.shape[1])
+    if k <= 0:
+        return np.empty((sims.shape[0], 0), dtype=np.int32), np.empty((sims.shape[0], 0), dtype=np.float32)
+    part = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    vals = np.take_along_axis(sims, part, axis=1)
+    order = np.argsort(-vals, axis=1, kind="stable")
+    return (np.take_along_axis(part, order, axis=1).astype(np.int32),
+            np.take_along_axis(vals, order, axis=1).astype(np.float32))
+
+
+class SimilarityEngine:
+    """처방 x 약재 용량 행렬 기반 top-k 유사 처방"""
+
+    def __init__(self, store, k=NEIGHBOR_K):
+        self.store = store
+        self.k = k
+        n = len(store)
+        herbs = store.herbs
+        # g 이외 단위(예: 15알)는 1돈으로 본다
+        doses = herbs["grams"].fillna(DON_G).to_numpy(dtype=np.float32)
+        self.matrix = sparse.csr_matrix(
+            (doses, (herbs["id"].to_numpy(), herbs["herb"].cat.codes.to_numpy())),
+            shape=(n, len(herbs["herb"].cat.categories)), dtype=np.float32,
+        )
+        self.matrix.sum_duplicates()
+        self.columns = self.matrix.tocsc()
+        self.row_sum = np.asarray(self.matrix.sum(axis=1)).ravel()
+        norms = np.sqrt(np.asarray(self.matrix.multiply(self.matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        self.unit = sparse.csr_matrix(sparse.diags(1.0 / norms) @ self.matrix, dtype=np.float32)
+
+        self._lock = threading.Lock()
+        self._table = {}  # metric -> (ids, scores) 전체 사전 계산 결과
+        self._rows = {metric: {} for metric in SIMILARITY_METRICS}  # metric -> {id: (ids, scores)}
+
+    def _cosine(self, rows):
+        # 희소 x 희소 곱은 결과가 거의 dense 라 느리다: 블록 행만 dense 로 펴서 희소 x dense 로 곱한다
+        sims = np.ascontiguousarray((self.unit @ self.unit[rows].toarray().T).T)
+        sims[np.arange(len(rows)), rows] = -1.0
+        return sims
+
+    def _jaccard(self, rows):
+        n = self.matrix.shape[0]
+        sims = np.zeros((len(rows), n), dtype=np.float32)
+        indptr, indices, data = self.matrix.indptr, self.matrix.indices, self.matrix.data
+        cptr, cidx, cdata = self.columns.indptr, self.columns.indices, self.columns.data
+        for r, i in enumerate(rows):
+            mins = sims[r]
+            for col, dose in zip(indices[indptr[i]:indptr[i + 1]], data[indptr[i]:indptr[i + 1]]):
+                lo, hi = cptr[col], cptr[col + 1]
+                mins[cidx[lo:hi]] += np.minimum(cdata[lo:hi], dose)
+            mins /= np.maximum(self.row_sum[i] + self.row_sum - mins, 1e-9)
+            mins[i] = -1.0
+        return sims
+
+    def _compute(self, metric, rows):
+        sims = self._cosine(rows) if metric == "cosine" else self._jaccard(rows)
+        return _top_k(sims, self.k)
+
+    def precompute(self, metric):
+        """전체 처방의 이웃 목록을 블록 단위로 계산"""
+        with self._lock:
+            if metric in self._table:
+                return self._table[metric]
+            n = self.matrix.shape[0]
+            block = max(1, NEIGHBOR_BLOCK_CELLS // max(n, 1))
+            ids, scores = [], []
+            for start in range(0, n, block):
+                b_ids, b_scores = self._compute(metric, np.arange(start, min(start + block, n)))
+                ids.append(b_ids)
+                scores.append(b_scores)
+            k = min(self.k, n)
+            self._table[metric] = (
+                np.vstack(ids) if ids else np.empty((0, k), dtype=np.int32),
+                np.vstack(scores) if scores else np.empty((0, k), dtype=np.float32),
+            )
+            return self._table[metric]
+
+    def neighbors(self, formula_id, metric="cosine", k=5):
+        """[(처방 id, 점수), ...] - 공통 약재가 없는 처방은 제외"""
+        if metric not in self._table and self.matrix.shape[0] <= NEIGHBOR_PRECOMPUTE_LIMIT:
+            self.precompute(metric)
+        if metric in self._table:
+            ids, scores = self._table[metric][0][formula_id], self._table[metric][1][formula_id]
+        else:
+            cache = self._rows[metric]
+            if formula_id not in cache:
+                b_ids, b_scores = self._compute(metric, np.array([formula_id]))
+                cache[formula_id] = (b_ids[0], b_scores[0])
+            ids, scores = cache[formula_id]
+        return [(int(i), float(s)) for i, s in zip(ids[:k], scores[:k]) if s > 0]
+
+
+@st.cache_resource(max_entries=1)
+def _build_similarity_engine(_store, version):
+    return SimilarityEngine(_store)
+
+
+def load_similarity_engine():
+    catalog = load_catalog()
+    if catalog.backend == "db":  # FormulaDB 는 컴파일 때 계산한 이웃 목록을 조회
+        return catalog
+    return _build_similarity_engine(catalog, catalog.version)
+
+
+# ---------------------------------------------------------
+# 6. 용량 계산 & 합방 (1돈=4g)
+#    * 처방전 표(rx_no, formula_id, cheop, factor)를 약재 long 표와 한 번에 조인
+#    * 같은 rx_no 의 여러 처방은 합방: 공통 약재를 합산(sum) 또는 큰 용량(max)으로
+#    * 하루치 처방전 묶음도 groupby 한 번으로 약재별 총량 계산
+# ---------------------------------------------------------
+DOSE_POLICIES = {"sum": "공통 약재 합산", "max": "공통 약재 큰 용량"}
+DOSE_UNITS = {"g": 1.0, "돈": DON_G}
+COMBO_SEARCH_LIMIT = 20  # 합방 선택지로 보낼 검색 결과 수
+BATCH_COLUMNS = {"처방번호": "rx_no", "처방명": "name", "출처": "source", "첩수": "cheop", "계수": "factor"}
+BATCH_LABELS = {col: label for label, col in BATCH_COLUMNS.items()}
+BATCH_REQUIRED = ("처방번호", "처방명")
+
+
+def to_don(grams):
+    return grams / DON_G
+
+
+def prescription_doses(store, orders, policy="sum"):
+    """처방전별 약재 용량
+
+    store: FormulaStore 또는 FormulaDB (herb_rows 로 필요한 처방의 약재만 읽는다)
+    orders: rx_no, formula_id, cheop(첩 수, 기본 1), factor(환자 계수, 기본 1.0)
+    반환: rx_no, herb, cheop_g(1첩 용량), total_g(첩 수·계수 반영). g 이외 단위만 있는 약재는 NaN.
+    첩 수·계수는 처방 행마다 먼저 곱한 뒤 합산/최대를 구하므로 같은 rx_no 안에서 달라도 된다.
+    """
+    orders = orders.reindex(columns=["rx_no", "formula_id", "cheop", "factor"])
+    orders["cheop"] = orders["cheop"].fillna(1)
+    orders["factor"] = orders["factor"].fillna(1.0)
+
+    herbs = store.herb_rows(orders["formula_id"].unique()).rename(columns={"id": "formula_id"})
+    merged = orders.merge(herbs, on="formula_id")
+    merged["scaled"] = merged["grams"] * merged["cheop"] * merged["factor"]
+    doses = merged.groupby(["rx_no", "herb"], observed=True, sort=False).agg(
+        cheop_g=("grams", policy), total_g=("scaled", policy), known=("grams", "count"),
+    )
+    known = doses.pop("known") > 0
+    doses[["cheop_g", "total_g"]] = doses[["cheop_g", "total_g"]].where(known, axis=0)
+    return doses.reset_index()
+
+
+def batch_totals(doses):
+    """처방전별 용량 -> 약재별 총량 (total_g, total_don), 많은 순"""
+    totals = doses.groupby("herb", observed=True)["total_g"].sum(min_count=1).sort_values(ascending=False)
+    return totals.to_frame("total_g").assign(total_don=lambda df: to_don(df["total_g"]))
+
+
+def read_batch_orders(store, file):
+    """처방번호, 처방명, 출처(선택), 첩수, 계수 CSV -> orders 표 (처방을 찾지 못한 행은 formula_id 가 NaN)
+
+    처방명 대신 약어도 쓸 수 있고, 출처를 적으면 같은 이름의 변형 중 그 출처의 처방을 쓴다.
+    필수 열이 없거나 첩수·계수가 양수가 아닌 행이 있으면 ValueError (빈 칸은 기본값 1).
+    """
+    orders = pd.read_csv(file, dtype={"처방번호": str, "출처": str})
+    missing = [col for col in BATCH_REQUIRED if col not in orders.columns]
+    if missing:
+        raise ValueError(f"CSV 에 {', '.join(missing)} 열이 없습니다.")
+    orders = orders.rename(columns=BATCH_COLUMNS)
+    for col in ("cheop", "factor"):
+        if col not in orders.columns:
+            continue
+        values = pd.to_numeric(orders[col], errors="coerce")
+        bad = (values.isna() & orders[col].notna()) | (values <= 0)
+        if bad.any():
+            lines = ", ".join(map(str, (orders.index[bad] + 2)[:20]))  # 머리글이 1행
+            raise ValueError(f"{BATCH_LABELS[col]} 값이 양수가 아닌 행이 있습니다 (CSV {lines}행).")
+        orders[col] = values
+    orders["formula_id"] = store.resolve(orders["name"], orders.get("source"))
+    return orders
+
+
+# ---------------------------------------------------------
+# 7. 배합 금기 검사 (십팔반 · 십구외 · 임신 금기/신중)
+#    * 약재마다 비트 위치를 주고 처방별 약재 비트셋(uint64 워드 배열)을 미리 계산
+#    * 처방 조합 검사 = 비트셋 OR 후 규칙 마스크와 AND 몇 번
+#    * 처방전 로그 일괄 검사는 처방번호별 OR(reduceat) 후 규칙별로 한꺼번에 AND
+# ---------------------------------------------------------
+# (구분, 약재 묶음 A, 약재 묶음 B) - A 와 B 를 함께 쓰면 경고
+HERB_CONFLICT_RULES = [
+    ("십팔반", ("감초", "자감초", "생감초"), ("감수", "대극", "원화", "해조")),
+    ("십팔반", ("오두", "천오", "초오", "부자", "백부자"),
+     ("반하", "과루", "과루실", "과루인", "과루피", "과루근", "천화분", "패모", "천패모", "절패모", "백렴", "백급")),
+    ("십팔반", ("여로",), ("인삼", "사삼", "단삼", "현삼", "고삼", "세신", "작약", "백작약", "적작약")),
+    ("십구외", ("유황",), ("박초", "망초")),
+    ("십구외", ("수은",), ("비상",)),
+    ("십구외", ("낭독",), ("밀타승",)),
+    ("십구외", ("파두",), ("견우자",)),
+    ("십구외", ("정향",), ("울금",)),
+    ("십구외", ("천오", "초오"), ("서각",)),
+    ("십구외", ("아초", "망초"), ("삼릉",)),
+    ("십구외", ("관계", "육계", "계심"), ("적석지",)),
+    ("십구외", ("인삼",), ("오령지",)),
+]
+PREGNANCY_CAUTIONS = {
+    "금기": ("파두", "견우자", "대극", "감수", "원화", "상륙", "사향", "삼릉", "봉출", "아출", "수질", "맹충",
+             "반모", "웅황", "수은", "경분", "천오", "초오"),
+    "신중": ("도인", "홍화", "대황", "망초", "지실", "부자", "육계", "우슬", "천산갑", "유향", "몰약", "반하",
+             "남성", "전갈", "오공", "구맥", "목통", "활석"),
+}
+
+
+def herb_bitsets(store):
+    """(약재 목록, 처방 x 워드 uint64 비트셋) - 약재 i 는 워드 i // 64 의 비트 i % 64"""
+    herbs = store.herbs
+    vocab = list(herbs["herb"].cat.categories)
+    codes = herbs["herb"].cat.codes.to_numpy().astype(np.int64)
+    bits = np.zeros((len(store), max(1, -(-len(vocab) // 64))), dtype=np.uint64)
+    np.bitwise_or.at(
+        bits, (herbs["id"].to_numpy(), codes >> 6),
+        np.left_shift(np.uint64(1), (codes & 63).astype(np.uint64)),
+    )
+    return vocab, bits
+
+
+class IncompatibilityChecker:
+    """처방별 약재 비트셋 + 금기 규칙 마스크
+
+    formula_bits: 처방 id 배열 -> (len(ids), 워드 수) uint64 비트셋.
+    메모리 저장소는 미리 만든 배열에서, FormulaDB 는 컴파일 때 저장한 비트셋을 조회한다.
+    """
+
+    def __init__(self, vocab, formula_bits):
+        self.vocab = list(vocab)
+        self.positions = {herb: i for i, herb in enumerate(self.vocab)}
+        self.n_words = max(1, -(-len(self.vocab) // 64))
+        self.formula_bits = formula_bits
+
+        self.rules = [(kind, self.mask(a), self.mask(b)) for kind, a, b in HERB_CONFLICT_RULES]
+        self.rules = [(kind, a, b) for kind, a, b in self.rules if a.any() and b.any()]
+        self.pregnancy = [(f"임신 {level}", self.mask(names)) for level, names in PREGNANCY_CAUTIONS.items()]
+
+    @classmethod
+    def from_store(cls, store):
+        vocab, bits = herb_bitsets(store)
+        return cls(vocab, lambda ids: bits[ids])
+
+    def mask(self, names):
+        m = np.zeros(self.n_words, dtype=np.uint64)
+        for name in names:
+            pos = self.positions.get(name)
+            if pos is not None:
+                m[pos >> 6] |= np.uint64(1) << np.uint64(pos & 63)
+        return m
+
+    def herbs_in(self, bits):
+        positions = np.flatnonzero(np.unpackbits(bits.astype("<u8").view(np.uint8), bitorder="little"))
+        return [self.vocab[i] for i in positions]
+
+    def _warnings(self, combined):
+        warnings = []
+        for kind, a, b in self.rules:
+            hit_a, hit_b = combined & a, combined & b
+            if hit_a.any() and hit_b.any():
+                warnings.append((kind, f"{'·'.join(self.herbs_in(hit_a))} ↔ {'·'.join(self.herbs_in(hit_b))}"))
+        for kind, m in self.pregnancy:
+            hit = combined & m
+            if hit.any():
+                warnings.append((kind, "·".join(self.herbs_in(hit))))
+        return warnings
+
+    def check(self, formula_ids):
+        """처방 id 들을 함께 쓸 때의 [(구분, 약재), ...]"""
+        return self._warnings(np.bitwise_or.reduce(self.formula_bits(list(formula_ids)), axis=0))
+
+    def screen(self, orders):
+        """orders(rx_no, formula_id) -> 경고가 있는 처방전만 (rx_no, kind, herbs) 표"""
+        orders = orders.sort_values("rx_no", kind="stable")
+        starts = np.flatnonzero(np.r_[True, orders["rx_no"].to_numpy()[1:] != orders["rx_no"].to_numpy()[:-1]])
+        if not len(orders):
+            return pd.DataFrame(columns=["rx_no", "kind", "herbs"])
+        combined = np.bitwise_or.reduceat(self.formula_bits(orders["formula_id"].to_numpy()), starts, axis=0)
+        rx_nos = orders["rx_no"].to_numpy()[starts]
+
+        flagged = np.zeros(len(starts), dtype=bool)
+        for _, a, b in self.rules:
+            flagged |= (combined & a).any(axis=1) & (combined & b).any(axis=1)
+        for _, m in self.pregnancy:
+            flagged |= (combined & m).any(axis=1)
+
+        rows = [
+            (rx_nos[i], kind, herbs)
+            for i in np.flatnonzero(flagged)
+            for kind, herbs in self._warnings(combined[i])
+        ]
+        return pd.DataFrame(rows, columns=["rx_no", "kind", "herbs"])
+
+
+@st.cache_resource(max_entries=1)
+def _build_checker(_catalog, version):
+    if _catalog.backend == "db":  # FormulaDB 는 컴파일 때 저장한 비트셋을 조회
+        return IncompatibilityChecker(_catalog.herb_vocab(), _catalog.formula_bits)
+    return IncompatibilityChecker.from_store(_catalog)
+
+
+def load_checker():
+    catalog = load_catalog()
+    return _build_checker(catalog, catalog.version)
+
+
+# ---------------------------------------------------------
+# 8. SQLite 백엔드 (선택, HANBANG_DB)
+#    * FORMULA_BOOK + formulas.csv 를 파싱된 표 + 검색 n-gram 역색인으로 미리 컴파일
+#      (SearchIndex 와 같은 색인을 n-gram 하나당 id 배열 BLOB 한 행으로 저장 -> 검색 결과·순위가 같다)
+#    * 목차 순서는 categories 표의 id 순서로 보존
+#    * 유사 처방 이웃 목록과 처방별 약재 비트셋도 컴파일 때 미리 계산해 저장
+#    * 앱은 읽기 전용 연결 풀로 목차·검색·처방 하나의 약재/이웃/금기를 바로 조회
+#      (mmap 으로 워커 간 페이지 캐시 공유, 처방을 펼쳐도 전체 표를 읽지 않는다)
+#    * 약재 조합 검색·CSV 일괄 계산처럼 전체가 필요한 기능만 DB 의 파싱된 표에서 저장소를 읽어 만든다
+# ---------------------------------------------------------
+DB_SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE categories (id INTEGER PRIMARY KEY, main_cat TEXT NOT NULL, sub_cat TEXT NOT NULL);
+CREATE TABLE formulas (
+    id INTEGER PRIMARY KEY, category_id INTEGER NOT NULL REFERENCES categories(id),
+    name TEXT, abbr TEXT, source TEXT, main_cat TEXT, sub_cat TEXT, rx TEXT, info TEXT,
+    norm_name TEXT, canonical_id INTEGER, variant_no INTEGER, n_variants INTEGER
+);
+CREATE TABLE formula_herbs (formula_id INTEGER NOT NULL REFERENCES formulas(id), herb TEXT, grams REAL);
+CREATE TABLE search_texts (id INTEGER PRIMARY KEY, name TEXT, abbr TEXT, info TEXT, rx TEXT, choseong TEXT);
+CREATE TABLE search_postings (
+    field TEXT NOT NULL, gram TEXT NOT NULL, ids BLOB NOT NULL,
+    PRIMARY KEY (field, gram)
+) WITHOUT ROWID;
+CREATE TABLE herb_vocab (pos INTEGER PRIMARY KEY, herb TEXT NOT NULL);
+CREATE TABLE formula_bits (formula_id INTEGER PRIMARY KEY, bits BLOB NOT NULL);
+CREATE TABLE neighbors (
+    metric TEXT NOT NULL, formula_id INTEGER NOT NULL, rank INTEGER NOT NULL,
+    neighbor_id INTEGER NOT NULL, score REAL NOT NULL,
+    PRIMARY KEY (metric, formula_id, rank)
+) WITHOUT ROWID;
+"""
+DB_INDEXES = """
+CREATE INDEX formulas_category ON formulas(category_id, id);
+CREATE INDEX formula_herbs_formula ON formula_herbs(formula_id);
+CREATE INDEX formula_herbs_herb ON formula_herbs(herb);
+"""
+DB_FORMULA_COLUMNS = ["id", "name", "abbr", "source", "main_cat", "sub_cat", "rx", "info",
+                      "norm_name", "canonical_id", "variant_no", "n_variants"]
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_SCHEMA_VERSION = "3"  # FTS5 대신 SearchIndex 와 같은 n-gram 역색인
+DB_IN_LIMIT = 500  # 이보다 많은 처방의 비트셋은 표 전체를 한 번에 읽어 고른다. IN (...) 한 번에 넣는 id 수
+
+
+def compile_db(path, store):
+    """저장소를 읽기 전용 SQLite 파일로 컴파일 (임시 파일에 쓴 뒤 교체)"""
+    tmp = path + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    formulas = store.formulas
+    category_ids = {key: i for i, key in enumerate(store.categories)}
+    con = sqlite3.connect(tmp)
+    try:
+        con.executescript(DB_SCHEMA)
+        con.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ("schema", DB_SCHEMA_VERSION),
+            ("n_formulas", str(len(store))),
+            ("version", repr(store.version)),
+        ])
+        con.executemany(
+            "INSERT INTO categories VALUES (?, ?, ?)",
+            [(i, main_cat, sub_cat) for (main_cat, sub_cat), i in category_ids.items()],
+        )
+        keys = zip(formulas["main_cat"].tolist(), formulas["sub_cat"].tolist())
+        rows = formulas[DB_FORMULA_COLUMNS].assign(category_id=[category_ids[key] for key in keys])
+        rows.to_sql("formulas", con, if_exists="append", index=False)
+        store.herbs.rename(columns={"id": "formula_id"}).assign(herb=lambda df: df["herb"].astype(str)).to_sql(
+            "formula_herbs", con, if_exists="append", index=False,
+        )
+
+        texts = search_texts(formulas)
+        con.executemany(f"INSERT INTO search_texts VALUES (?, {', '.join('?' * len(SEARCH_COLUMNS))})",
+                        zip(formulas["id"].tolist(), *(texts[field].tolist() for field in SEARCH_COLUMNS)))
+        for field, _, sizes in SEARCH_FIELDS + CHOSEONG_FIELDS:
+            postings = build_postings(texts[field], sizes)
+            con.executemany("INSERT INTO search_postings VALUES (?, ?, ?)",
+                            ((field, gram, ids.astype("<i4").tobytes()) for gram, ids in postings.items()))
+
+        vocab, bits = herb_bitsets(store)
+        con.executemany("INSERT INTO herb_vocab VALUES (?, ?)", enumerate(vocab))
+        con.executemany("INSERT INTO formula_bits VALUES (?, ?)",
+                        ((i, row.astype("<u8").tobytes()) for i, row in enumerate(bits)))
+
+        engine = SimilarityEngine(store)
+        for metric in SIMILARITY_METRICS:
+            ids, scores = engine.precompute(metric)
+            formula_ids, ranks = np.nonzero(scores > 0)
+            con.executemany("INSERT INTO neighbors VALUES (?, ?, ?, ?, ?)", zip(
+                [metric] * len(ranks), formula_ids.tolist(), ranks.tolist(),
+                ids[formula_ids, ranks].tolist(), scores[formula_ids, ranks].tolist(),
+            ))
+        con.executescript(DB_INDEXES)
+        con.commit()
+        con.execute("VACUUM")
+    finally:
+        con.close()
+    os.replace(tmp, path)
+
+
+class FormulaDB(NgramSearch):
+    """읽기 전용 SQLite 처방 DB - 목차 / 페이지 조회 / 통합 검색 (FormulaStore 와 같은 조회 메서드)"""
+
+    backend = "db"  # FormulaStore.backend 참고
+
+    def __init__(self, path, version):
+        super().__init__()
+        self.path = path
+        self.version = version
+        self._pool = queue.SimpleQueue()
+
+        with self.connection() as con:
+            schema = con.execute("SELECT value FROM meta WHERE key = 'schema'").fetchone()
+            if schema is None or schema[0] != DB_SCHEMA_VERSION:
+                raise RuntimeError(f"{path} 는 이전 형식의 DB 입니다. python -m app compile-db 로 다시 컴파일하세요.")
+            self.toc = {}
+            self._category_ids = {}
+            for cid, main_cat, sub_cat in con.execute("SELECT id, main_cat, sub_cat FROM categories ORDER BY id"):
+                self.toc.setdefault(main_cat, []).append(sub_cat)
+                self._category_ids[(main_cat, sub_cat)] = cid
+            self._len = con.execute("SELECT count(*) FROM formulas").fetchone()[0]
+            self._n_words = max(1, -(-con.execute("SELECT count(*) FROM herb_vocab").fetchone()[0] // 64))
+
+    def _connect(self):
+        con = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        con.execute("PRAGMA query_only = 1")
+        con.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        return con
+
+    @contextmanager
+    def connection(self):
+        """풀에서 연결을 빌려 쓰고 돌려놓는다 (연결은 한 번에 한 스레드만 사용)"""
+        try:
+            con = self._pool.get_nowait()
+        except queue.Empty:
+            con = self._connect()
+        try:
+            yield con
+        finally:
+            self._pool.put(con)
+
+    def __len__(self):
+        return self._len
+
+    def category_ids(self, main_cat, sub_cat):
+        with self.connection() as con:
+            cur = con.execute("SELECT id FROM formulas WHERE category_id = ? ORDER BY id",
+                              (self._category_ids[(main_cat, sub_cat)],))
+            return np.array([row[0] for row in cur], dtype=np.int32)
+
+    def rows(self, ids):
+        ids = [int(i) for i in ids]
+        if not ids:
+            return []
+        with self.connection() as con:
+            cur = con.execute(
+                f"SELECT {', '.join(DB_FORMULA_COLUMNS)} FROM formulas WHERE id IN ({', '.join('?' * len(ids))})", ids,
+            )
+            by_id = {row[0]: dict(zip(DB_FORMULA_COLUMNS, row)) for row in cur}
+        return [by_id[i] for i in ids]
+
+    def formula_herbs(self, formula_id):
+        """[(약재, g 또는 None), ...] - formula_herbs 표에서 처방 하나만 읽는다"""
+        with self.connection() as con:
+            cur = con.execute("SELECT herb, grams FROM formula_herbs WHERE formula_id = ? ORDER BY rowid",
+                              (int(formula_id),))
+            return [(herb, None if g is None else float(g)) for herb, g in cur]
+
+    def herb_rows(self, ids):
+        """처방 id 들의 약재 long 표 (id, herb, grams)"""
+        ids = [int(i) for i in ids]
+        with self.connection() as con:
+            return pd.read_sql(
+                f"SELECT formula_id AS id, herb, grams FROM formula_herbs "
+                f"WHERE formula_id IN ({', '.join('?' * len(ids))}) ORDER BY formula_id, rowid", con, params=ids,
+            )
+
+    def neighbors(self, formula_id, metric="cosine", k=5):
+        """[(처방 id, 점수), ...] - 컴파일 때 계산한 이웃 목록 (SimilarityEngine.neighbors 와 같은 결과)"""
+        with self.connection() as con:
+            cur = con.execute("SELECT neighbor_id, score FROM neighbors WHERE metric = ? AND formula_id = ? "
+                              "ORDER BY rank LIMIT ?", (metric, int(formula_id), k))
+            return [(int(i), float(s)) for i, s in cur]
+
+    def herb_vocab(self):
+        with self.connection() as con:
+            return [herb for herb, in con.execute("SELECT herb FROM herb_vocab ORDER BY pos")]
+
+    def formula_bits(self, ids):
+        """처방 id 배열 -> (len(ids), 워드 수) uint64 약재 비트셋"""
+        ids = np.asarray(ids, dtype=np.int64)
+        with self.connection() as con:
+            if len(ids) > DB_IN_LIMIT:
+                blob = b"".join(bits for bits, in con.execute("SELECT bits FROM formula_bits ORDER BY formula_id"))
+                return np.frombuffer(blob, dtype="<u8").reshape(self._len, self._n_words)[ids]
+            cur = con.execute(f"SELECT formula_id, bits FROM formula_bits "
+                              f"WHERE formula_id IN ({', '.join('?' * len(ids))})", ids.tolist())
+            by_id = dict(cur)
+        return np.frombuffer(b"".join(by_id[i] for i in ids.tolist()), dtype="<u8").reshape(len(ids), self._n_words)
+
+    def _hits(self, field, grams):
+        grams = list(grams)
+        with self.connection() as con:
+            cur = con.execute(f"SELECT ids FROM search_postings WHERE field = ? AND gram IN ({', '.join('?' * len(grams))})",
+                              [field] + grams)
+            return [np.frombuffer(ids, dtype="<i4") for ids, in cur]
+
+    def _field_texts(self, fields, ids):
+        """ids 순서대로 [(필드별 텍스트, ...), ...] - search_texts 표에서 후보만 읽는다"""
+        columns = ", ".join(field for field, _, _ in fields)
+        by_id = {}
+        with self.connection() as con:
+            for start in range(0, len(ids), DB_IN_LIMIT):
+                chunk = ids[start:start + DB_IN_LIMIT]
+                cur = con.execute(f"SELECT id, {columns} FROM search_texts WHERE id IN ({', '.join('?' * len(chunk))})",
+                                  chunk)
+                by_id.update((row[0], row[1:]) for row in cur)
+        return [by_id[i] for i in ids]
+
+
+@st.cache_resource(max_entries=1)
+def _open_db(path, mtime):
+    return FormulaDB(path, version=(path, mtime))
+
+
+@st.cache_resource(max_entries=1)
+def _load_db_store(path, mtime):
+    """DB 의 파싱된 표로 메모리 저장소를 만든다 (rx 재파싱 없음)"""
+    db = _open_db(path, mtime)
+    with db.connection() as con:
+        formulas = pd.read_sql(f"SELECT {', '.join(DB_FORMULA_COLUMNS)} FROM formulas ORDER BY id", con)
+        herbs = pd.read_sql("SELECT formula_id AS id, herb, grams FROM formula_herbs ORDER BY formula_id, rowid", con)
+    formulas = formulas.astype({"id": "int32", "canonical_id": "int32", "variant_no": "int16", "n_variants": "int16"})
+    return FormulaStore.from_frames(formulas, herbs, version=db.version)
+
+
+def load_catalog():
+    """목차·페이지·검색용 조회 객체: HANBANG_DB 가 있으면 FormulaDB, 없으면 메모리 저장소"""
+    db_mtime = _mtime(FORMULAS_DB) if FORMULAS_DB else None
+    if db_mtime is not None:
+        return _open_db(FORMULAS_DB, db_mtime)
+    return load_store()
+
+
+# ---------------------------------------------------------
+# 9. 메인 로직 (계층형 탐색 & 페이지 보기 & 검색)
+#    * 처방 본문은 접힌 채로 두고 펼칠 때만 그린다 (expander on_change="rerun")
+#    * 처방 리스트만 st.fragment: 페이지 이동·처방 펼치기는 리스트만 다시 실행하고 목차는 다시 그리지 않는다
+#    * 목표: 처방 500개 이상인 소분류에서도 소분류/페이지 전환 재실행 150ms 이내
+# ---------------------------------------------------------
+PAGE_SIZE = 20
+LIST_RERUN_TARGET_MS = 150
+
+
+def render_similar(formula_id):
+    metric = st.session_state.get("similarity_metric", "cosine")
+    neighbors = load_similarity_engine().neighbors(formula_id, metric)
+    st.markdown("**🔗 비슷한 처방**")
+    if not neighbors:
+        st.caption("공통 약재가 있는 처방이 없습니다.")
+        return
+    rows = load_catalog().rows([i for i, _ in neighbors])
+    st.markdown("\n".join(f"- {row['name']} `{score:.2f}`" for row, (_, score) in zip(rows, neighbors)))
+
+
+def render_warnings(warnings):
+    for kind, herbs in warnings:
+        if kind.startswith("임신"):
+            st.warning(f"**{kind}:** {herbs}", icon="🤰")
+        else:
+            st.error(f"**{kind}:** {herbs}", icon="⚠️")
+
+
+def render_formula(formula, expanded=False):
+    box = st.expander(f"💊 {formula['name']}", expanded=expanded, key=f"formula:{formula['id']}", on_change="rerun")
+    if not box.open:
+        return
+    with box:
+        c1, c2, c3 = st.columns([1.5, 1, 0.8])
+        with c1:
+            st.success(f"**적응증:** {formula['info']}")
+        with c2:
+            st.code(formula['rx'], language="text")
+        with c3:
+            render_similar(formula["id"])
+        note = f"출처: {formula['source']}"
+        if formula["n_variants"] > 1:
+            note += f" · 동명 처방 {formula['variant_no'] + 1}/{formula['n_variants']}"
+        st.caption(note)
+        render_warnings(load_checker().check([formula["id"]]))
+
+
+def page_number(n_items, key):
+    """n_items 개를 PAGE_SIZE 개씩 나눌 때 고른 페이지 (한 쪽뿐이면 입력 없이 1)"""
+    n_pages = max(1, -(-n_items // PAGE_SIZE))
+    if n_pages == 1:
+        return 1
+    return st.number_input(f"페이지 (총 {n_pages}쪽):", min_value=1, max_value=n_pages, step=1, key=f"page:{key}")
+
+
+def render_formula_rows(ids, show_category=False):
+    for formula in load_catalog().rows(ids):
+        if show_category:
+            st.caption(f"{formula['main_cat']} › {formula['sub_cat']}")
+        render_formula(formula)
+
+
+def render_formula_page(ids, key, show_category=False):
+    """ids 중 한 페이지(PAGE_SIZE 개)만 그린다"""
+    start = (page_number(len(ids), key) - 1) * PAGE_SIZE
+    render_formula_rows(ids[start:start + PAGE_SIZE], show_category)
+
+
+@st.fragment
+def render_formula_list(main_cat, sub_cat):
+    """소분류 처방 리스트 - 페이지를 넘기거나 처방을 펼치면 이 부분만 다시 실행 (목차는 그대로)"""
+    catalog = load_catalog()
+    st.header(f"📋 [{sub_cat}] 처방 리스트")
+    target_ids = catalog.category_ids(main_cat, sub_cat)
+    st.info(f"이 항목에 해당하는 {len(target_ids)}개의 처방을 {PAGE_SIZE}개씩 보여줍니다. 처방을 펼치면 내용이 표시됩니다.")
+
+    render_formula_page(target_ids, key=f"{main_cat}/{sub_cat}")
+
+
+def render_toc():
+    catalog = load_catalog()
     col_left, col_right = st.columns([1, 2.5])
 
     with col_left:
         st.header("📂 목차")
         
         # 1. 대분류 선택
-        main_cats = list(FORMULA_BOOK.keys())
+        main_cats = list(catalog.toc.keys())
         selected_main_cat = st.radio("대분류 선택:", main_cats)
         
         st.divider()
 
         # 2. 중분류 선택
-        sub_cats = FORMULA_BOOK[selected_main_cat]
-        selected_sub_cat_name = st.radio(f"[{selected_main_cat}] 소분류 선택:", list(sub_cats.keys()))
+        sub_cats = catalog.toc[selected_main_cat]
+        selected_sub_cat_name = st.radio(f"[{selected_main_cat}] 소분류 선택:", sub_cats)
 
     with col_right:
-        st.header(f"📋 [{selected_sub_cat_name}] 처방 리스트")
-        st.info(f"이 항목에 해당하는 {len(sub_cats[selected_sub_cat_name])}개의 처방을 모두 보여줍니다.")
-        
-        target_formulas = sub_cats[selected_sub_cat_name]
+        render_formula_list(selected_main_cat, selected_sub_cat_name)
+
+
+def render_herb_query():
+    index = load_herb_index()
+
+    st.header("🌿 약재 조합 검색")
+    c1, c2 = st.columns(2)
+    with c1:
+        include = st.multiselect("모두 포함할 약재:", index.herbs)
+    with c2:
+        exclude = st.multiselect("제외할 약재:", index.herbs)
+
+    if not include and not exclude:
+        st.info("포함하거나 제외할 약재를 선택하세요.")
+        return
+
+    ids = index.query(include, exclude)
+    st.info(f"조건에 맞는 처방 {len(ids)}개")
+    render_formula_page(ids, key="herb_query", show_category=True)
+
+
+def render_search():
+    index = load_search_index()
+
+    st.header("🔎 통합 검색")
+    query = st.text_input("처방명 · 약어 · 적응증 · 약재 (초성 검색 가능, 예: ㅅㅅㅎㅌ):")
+    if not query.strip():
+        st.info("검색어를 입력하세요.")
+        return
+
+    total = index.count(query)
+    if total > SEARCH_RESULT_LIMIT:
+        st.info(f"검색 결과 {total}개 중 점수 상위 {SEARCH_RESULT_LIMIT}개만 보여줍니다. 검색어를 더 구체적으로 입력해 보세요.")
+    else:
+        st.info(f"검색 결과 {total}개")
+    # 순위는 지금 보는 쪽까지만 확정한다 (뒤쪽 결과는 부분 문자열을 확인하지 않음)
+    page = page_number(min(total, SEARCH_RESULT_LIMIT), key="search")
+    results = index.search(query, limit=page * PAGE_SIZE)
+    render_formula_rows([i for i, _ in results[(page - 1) * PAGE_SIZE:]], show_category=True)
+
+
+def render_dose_table(table, unit):
+    per_unit = DOSE_UNITS[unit]
+    st.dataframe((table / per_unit).round(2).rename(columns=lambda c: f"{c} ({unit})"))
+
+
+def read_upload_orders(store, upload):
+    """업로드한 처방전 CSV -> 처방을 찾은 행만 남긴 orders (형식이 잘못되면 오류를 보이고 None)"""
+    try:
+        orders = read_batch_orders(store, upload)
+    except ValueError as e:  # pandas 의 ParserError·EmptyDataError 도 ValueError
+        st.error(f"처방전 CSV 를 읽을 수 없습니다: {e}")
+        return None
+    missing = orders.loc[orders["formula_id"].isna(), "name"].unique()
+    if len(missing):
+        st.warning(f"찾을 수 없는 처방 {len(missing)}개: {', '.join(map(str, missing[:20]))}")
+    return orders.dropna(subset=["formula_id"]).astype({"formula_id": "int64"})
+
+
+def render_dose_calculator():
+    st.header("⚖️ 용량 계산 / 합방")
+    c1, c2, c3, c4 = st.columns(4)
+    with c1:
+        cheop = st.number_input("첩 수:", min_value=1, value=1, step=1)
+    with c2:
+        factor = st.number_input("환자 계수:", min_value=0.1, value=1.0, step=0.1)
+    with c3:
+        policy = st.radio("합방 방식:", list(DOSE_POLICIES), format_func=DOSE_POLICIES.get)
+    with c4:
+        unit = st.radio("단위:", list(DOSE_UNITS), horizontal=True)
+
+    # 전체 처방 목록 대신 검색 결과 + 이미 고른 처방만 선택지로 보낸다
+    query = st.text_input("합방할 처방 찾기 (처방명 · 약어 · 초성):", key="combo_query")
+    found = [i for i, _ in load_search_index().search(query, limit=COMBO_SEARCH_LIMIT)] if query.strip() else []
+    options = list(dict.fromkeys(st.session_state.get("combo_ids", []) + found))
+    labels = {f["id"]: f"{f['name']} ({f['source']})" for f in load_catalog().rows(options)}
+    selected = st.multiselect("합방할 처방:", options, format_func=labels.get, key="combo_ids")
+    if selected:
+        orders = pd.DataFrame({"rx_no": 0, "formula_id": selected, "cheop": cheop, "factor": factor})
+        doses = prescription_doses(load_catalog(), orders, policy).set_index("herb")
+        render_dose_table(doses[["cheop_g", "total_g"]].rename(columns={"cheop_g": "1첩", "total_g": "총량"}), unit)
+        render_warnings(load_checker().check(selected))
+
+    st.divider()
+    st.subheader("📦 하루치 처방전 일괄 계산")
+    st.caption("CSV 열: 처방번호, 처방명(또는 약어), 출처(선택), 첩수, 계수(선택). "
+               "처방번호가 같은 행은 합방으로 계산하고, 출처를 적으면 같은 이름의 처방 중 그 출처의 것을 씁니다.")
+    upload = st.file_uploader("처방전 CSV:", type="csv")
+    if upload is None:
+        return
+
+    store = load_store()
+    orders = read_upload_orders(store, upload)
+    if orders is None:
+        return
+
+    totals = batch_totals(prescription_doses(store, orders, policy))
+    st.info(f"처방전 {orders['rx_no'].nunique()}건 · 약재 {len(totals)}종")
+    render_dose_table(totals[["total_g"]].rename(columns={"total_g": "총량"}), unit)
+    st.download_button("약재별 총량 CSV 받기", totals.to_csv().encode("utf-8-sig"), "batch_totals.csv", "text/csv")
+
+
+def render_conflict_screen():
+    st.header("🚫 배합 금기 일괄 검사")
+    st.caption("CSV 열: 처방번호, 처방명(또는 약어), 출처(선택). 처방번호가 같은 행은 함께 복용하는 처방으로 보고 십팔반·십구외·임신 금기를 검사합니다.")
+    upload = st.file_uploader("처방전 로그 CSV:", type="csv", key="conflict_log")
+    if upload is None:
+        return
+
+    store = load_store()
+    checker = load_checker()
+    orders = read_upload_orders(store, upload)
+    if orders is None:
+        return
+
+    report = checker.screen(orders)
+    st.info(f"처방전 {orders['rx_no'].nunique()}건 중 {report['rx_no'].nunique()}건에서 경고 {len(report)}개")
+    st.dataframe(report.rename(columns={"rx_no": "처방번호", "kind": "구분", "herbs": "약재"}), hide_index=True)
+    st.download_button("검사 결과 CSV 받기", report.to_csv(index=False).encode("utf-8-sig"), "conflicts.csv", "text/csv")
+
+
+MODES = {
+    "📂 목차 탐색": render_toc,
+    "🔎 통합 검색": render_search,
+    "🌿 약재 조합 검색": render_herb_query,
+    "⚖️ 용량 계산 / 합방": render_dose_calculator,
+    "🚫 배합 금기 일괄 검사": render_conflict_screen,
+}
+
+
+def main():
+    st.set_page_config(page_title="의감중마 처방 대사전", layout="wide")
+    
+    st.title("📚 [석곡 의감중마] 처방 대사전 (Full Ver.)")
+    st.caption("의감중마의 모든 항목과 처방을 목차 순서대로 찾고 비교합니다.")
+    st.markdown("---")
+
+    mode = st.sidebar.radio("보기 방식:", list(MODES))
+    st.sidebar.radio("비슷한 처방 기준:", list(SIMILARITY_METRICS), format_func=SIMILARITY_METRICS.get,
+                     key="similarity_metric")
+    MODES[mode]()
+
+
+# ---------------------------------------------------------
+# 10. 명령줄 도구 (python -m app ...)
+#    * export: 전체 또는 조건에 맞는 처방을 JSONL / CSV 로 흘려 보낸다 (청크 단위 생성기)
+#    * lookup: 표준 입력의 처방명·약어 / 약재 조합 / 검색어를 줄마다 답한다
+#    * 화면과 같은 load_store / load_herb_index / load_search_index 를 그대로 쓴다
+# ---------------------------------------------------------
+EXPORT_COLUMNS = ["id", "name", "abbr", "source", "main_cat", "sub_cat", "info", "rx", "herbs",
+                  "canonical_id", "variant_no"]
+EXPORT_CHUNK = 1000
+LOOKUP_CHUNK = 10_000
+LOOKUP_WAIT_S = 0.05  # 이 시간 동안 다음 줄이 없으면 모인 줄을 바로 답한다
+
+
+def iter_export_records(store, ids):
+    """처방 id 들 -> 파싱된 약재(herbs: [{herb, grams}]) 를 포함한 레코드 (EXPORT_CHUNK 개씩 읽음)"""
+    for start in range(0, len(ids), EXPORT_CHUNK):
+        for row in store.rows(ids[start:start + EXPORT_CHUNK]):
+            row["id"] = int(row["id"])
+            row["herbs"] = [{"herb": herb, "grams": g} for herb, g in store.formula_herbs(row["id"])]
+            yield {col: row[col] for col in EXPORT_COLUMNS}
+
+
+def category_keys(store, category):
+    """'대분류' 또는 '대분류/소분류' -> (대분류, 소분류) 목록
+
+    '6. 부인/소아' 처럼 이름에 '/' 가 들어가도 되도록 문자열 전체를 대분류로 먼저 보고,
+    아니면 알려진 대분류 + '/' 로 시작하는지 확인한다. 없는 분류면 ValueError.
+    """
+    if category in store.toc:
+        return [(category, sub_cat) for sub_cat in store.toc[category]]
+    for main_cat, sub_cats in store.toc.items():
+        sub_cat = category.removeprefix(main_cat + "/")
+        if sub_cat != category and sub_cat in sub_cats:
+            return [(main_cat, sub_cat)]
+    raise ValueError(f"알 수 없는 분류입니다: {category}")
+
+
+def select_ids(store, query=None, herbs=(), exclude_herbs=(), category=None, limit=None):
+    """export 조건 -> 처방 id 배열 (검색어가 있으면 검색 순위, 아니면 id 순)
+
+    분류·약재 조건을 모두 적용한 뒤에 limit 개로 자른다.
+    """
+    ids = np.arange(len(store))
+    if category:
+        ids = np.sort(np.concatenate([store.categories[key] for key in category_keys(store, category)]))
+    if herbs or exclude_herbs:
+        ids = np.intersect1d(ids, load_herb_index().query(herbs, exclude_herbs))
+    if query:
+        ranked = np.array([i for i, _ in load_search_index().search(query, limit=len(store))], dtype=np.int64)
+        ids = ranked[np.isin(ranked, ids)]
+    return ids[:limit] if limit else ids
+
+
+def write_records(records, fmt, out, fieldnames=EXPORT_COLUMNS, flush=False):
+    """레코드 생성기를 JSONL / CSV 로 한 줄씩 쓴다 (CSV 의 herbs 열은 JSON 문자열)
+
+    flush: 줄마다 내보낸다 (답을 기다리는 lookup 클라이언트용)
+    """
+    if fmt == "jsonl":
+        for record in records:
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if flush:
+                out.flush()
+        return
+    writer = csv.DictWriter(out, fieldnames=fieldnames)
+    writer.writeheader()
+    for record in records:
+        if "herbs" in record:
+            record["herbs"] = json.dumps(record["herbs"], ensure_ascii=False)
+        writer.writerow(record)
+        if flush:
+            out.flush()
+
+
+def parse_lookup(line):
+    """'?왕래한열' -> 검색, '+계지 +작약 -마황' -> 약재 조합, 그 외 -> 처방명/약어"""
+    if line.startswith("?"):
+        return "search", line[1:].strip()
+    tokens = line.split()
+    if tokens and all(token[0] in "+-" and len(token) > 1 for token in tokens):
+        return "herbs", ([t[1:] for t in tokens if t[0] == "+"], [t[1:] for t in tokens if t[0] == "-"])
+    return "name", line
+
+
+def iter_line_batches(lines, size=LOOKUP_CHUNK, wait=LOOKUP_WAIT_S):
+    """줄 묶음 생성기 - size 줄이 모였거나 wait 초 동안 다음 줄이 오지 않으면 내보낸다
+
+    읽기는 별도 스레드가 맡으므로, 한 줄 쓰고 답을 기다리는 클라이언트도 멈추지 않는다.
+    """
+    inbox = queue.SimpleQueue()
+
+    def pump():
+        try:
+            for line in lines:
+                inbox.put(line)
+        finally:
+            inbox.put(None)
+
+    threading.Thread(target=pump, daemon=True).start()
+    while True:
+        line = inbox.get()
+        if line is None:
+            return
+        batch = [line]
+        while len(batch) < size:
+            try:
+                line = inbox.get(timeout=wait)
+            except queue.Empty:
+                break
+            if line is None:
+                yield batch
+                return
+            batch.append(line)
+        yield batch
+
+
+def iter_lookups(store, lines, limit=50):
+    """입력 줄마다 {"query", "kind", "matches": [레코드, ...]}
+
+    iter_line_batches 묶음마다 처방명은 한 번에 찾고, 결과 레코드도 한 번에 읽는다.
+    """
+    for chunk in iter_line_batches(lines):
+        parsed = [parse_lookup(line.strip()) for line in chunk if line.strip()]
+        names = pd.Series([arg for kind, arg in parsed if kind == "name"], dtype=object)
+        resolved = iter(store.resolve(names).tolist())
+        is_name = iter(names.map(normalize_name).isin(store.name_ids.index).tolist())
+
+        answers = []
+        for kind, arg in parsed:
+            if kind == "name":
+                # 처방명은 같은 이름의 변형 모두, 약어는 그 약어를 가진 처방만
+                formula_id, by_name = next(resolved), next(is_name)
+                if pd.isna(formula_id):
+                    ids = []
+                else:
+                    ids = store.variant_ids(int(formula_id)) if by_name else [int(formula_id)]
+            elif kind == "herbs":
+                ids = load_herb_index().query(*arg)[:limit]
+                arg = " ".join([f"+{h}" for h in arg[0]] + [f"-{h}" for h in arg[1]])
+            else:
+                ids = [i for i, _ in load_search_index().search(arg, limit=limit)]
+            answers.append((arg, kind, ids))
+
+        wanted = sorted({i for _, _, ids in answers for i in ids})
+        records = dict(zip(wanted, iter_export_records(store, wanted)))
+        for query, kind, ids in answers:
+            yield {"query": query, "kind": kind, "matches": [records[i] for i in ids]}
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app", description="의감중마 처방 데이터 도구")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("compile-db", help="FORMULA_BOOK + formulas.csv 를 읽기 전용 SQLite 파일로 컴파일")
+    p.add_argument("path", nargs="?", default=FORMULAS_DB or DEFAULT_DB)
+
+    p = commands.add_parser("export", help="처방 전체 또는 일부를 파싱된 약재·용량과 함께 내보내기")
+    p.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    p.add_argument("--query", help="통합 검색어 (순위순으로 내보냄)")
+    p.add_argument("--herb", action="append", default=[], help="모두 포함할 약재 (여러 번 지정)")
+    p.add_argument("--exclude-herb", action="append", default=[], help="제외할 약재 (여러 번 지정)")
+    p.add_argument("--category", help="'대분류' 또는 '대분류/소분류' (이름에 '/' 가 있어도 됨)")
+    p.add_argument("--limit", type=int)
+
+    p = commands.add_parser("lookup", help="표준 입력의 처방명·약어 / '+약재 -약재' / '?검색어' 를 줄마다 조회")
+    p.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    p.add_argument("--limit", type=int, default=50, help="약재 조합·검색 결과 최대 개수")
+
+    args = parser.parse_args(argv)
+    if args.command == "compile-db":
+        store = load_source_store()
+        compile_db(args.path, store)
+        print(f"처방 {len(store)}개 -> {args.path}")
+        return 0
+
+    store = load_store()
+    if args.command == "export":
+        try:
+            ids = select_ids(store, args.query, args.herb, args.exclude_herb, args.category, args.limit)
+        except ValueError as e:
+            parser.error(str(e))
+        write_records(iter_export_records(store, ids), args.format, sys.stdout)
+    elif args.command == "lookup":
+        results = iter_lookups(store, sys.stdin, args.limit)
+        if args.format == "jsonl":
+            write_records(results, "jsonl", sys.stdout, flush=True)
+        else:
+            # 찾지 못한 질의도 일치 열이 빈 행 하나로 남긴다 ('없음'과 '보내지 않음'을 구분)
+            rows = ({"query": r["query"], "kind": r["kind"], **match}
+                    for r in results for match in r["matches"] or [{}])
+            write_records(rows, "csv", sys.stdout, fieldnames=["query", "kind"] + EXPORT_COLUMNS, flush=True)
+    return 0
 
-        for formula in target_formulas:
-            with st.expander(f"💊 {formula['name']}", expanded=True):
-                c1, c2 = st.columns([1.5, 1])
-                with c1:
-                    st.success(f"**적응증:** {formula['info']}")
-                with c2:
-                    st.code(formula['rx'], language="text")
 
 if __name__ == "__main__":
-    main()
+    # streamlit run app.py 는 앱, python -m app / python app.py 는 명령줄 도구
+    if st.runtime.exists():
+        main()
+    else:
+        set_log_level("error")  # 캐시가 런타임 밖에서 쓰인다는 경고는 숨긴다
+        try:
+            sys.exit(cli())
+        except BrokenPipeError:  # '| head' 처럼 읽는 쪽이 먼저 닫힌 경우
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            sys.exit(1)
@@ -0,0 +1,315 @@
+"""의감중마 처방 대사전 벤치마크 (브라우저 없이)
+
+* 앱: streamlit.testing.v1.AppTest 로 app.py 를 실행해 콜드 스타트 / 첫 렌더 /
+  대분류·소분류 클릭과 페이지 이동마다의 재실행 시간을 잰다. 기본으로 소분류마다 처방이
+  500개씩 들어가는 10k 합성 코퍼스도 잰다 (합성 처방은 출처 20개로 나뉜다).
+  AppTest 는 fragment 만 다시 실행하지 못하므로 페이지 이동도 전체 재실행 시간이다 (fragment 재실행의 상한).
+* 데이터: 기존 처방과 같은 모양의 합성 코퍼스(1k / 10k / 100k)로 읽기 · 파싱 ·
+  색인 생성 · 조회 시간을 잰다.
+* 각 시간은 여러 번 잰 중앙값. 결과는 JSON 으로 저장하고, --baseline 으로 이전 결과와 비교해
+  느려진 항목을 알린다 (--min-delta-ms 보다 작은 차이는 잡음으로 보고 무시).
+
+    python bench.py --out bench_output.json
+    python bench.py --sizes 1000 10000 --baseline bench_output.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest
+from streamlit.testing.v1 import app_test, local_script_runner
+
+import app
+
+APP_PATH = os.path.join(app.BASE_DIR, "app.py")
+SEARCH_QUERIES = ["계지", "ㅅㅅㅎㅌ", "왕래한열", "소시오탕", "마", "태양병 발열"]
+FORMULA_SUFFIXES = ["탕", "산", "환", "음", "전"]
+QUERY_REPEAT = 20  # 1ms 안팎의 조회는 이만큼 반복한 중앙값
+
+
+def timed(fn, *args, repeat=1, **kwargs):
+    """(마지막 결과, 실행 시간 중앙값 ms)"""
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return result, statistics.median(times) * 1000
+
+
+# ---------------------------------------------------------
+# 합성 코퍼스 (formulas.csv 와 같은 열)
+# ---------------------------------------------------------
+def synthetic_frame(store, n, seed=0):
+    """기존 처방의 약재 빈도 · 용량 · 약재 수 · 적응증 문구 분포를 따르는 n 개 처방"""
+    rng = np.random.default_rng(seed)
+    herbs = store.herbs.dropna(subset=["grams"])
+    herb_freq = herbs["herb"].value_counts()
+    vocab = herb_freq.index.astype(str).to_numpy()
+    weights = (herb_freq / herb_freq.sum()).to_numpy()
+    doses = {herb: group.to_numpy() for herb, group in herbs.groupby("herb", observed=True)["grams"]}
+    sizes = store.herbs.groupby("id").size().to_numpy()
+    phrases = (store.formulas["info"].str.replace(app.CITATION_RE.pattern, "", regex=True)
+               .str.split(r"[,.]\s*").explode().str.strip())
+    phrases = phrases[phrases != ""].unique()
+    syllables = list({ch for name in store.formulas["norm_name"] for ch in name})
+
+    rows = []
+    for i in range(n):
+        k = min(int(rng.choice(sizes)), len(vocab))
+        picked = rng.choice(vocab, size=k, replace=False, p=weights)
+        rx = ", ".join(f"{herb} {rng.choice(doses[herb]):g}g" for herb in picked)
+        name = "".join(rng.choice(syllables, size=int(rng.integers(2, 5)))) + rng.choice(FORMULA_SUFFIXES)
+        info = ", ".join(rng.choice(phrases, size=int(rng.integers(1, 4)), replace=False))
+        rows.append((name, "", f"SYN{i % 20:02d}", rx, info))
+    return pd.DataFrame(rows, columns=list(app.CSV_COLUMNS))
+
+
+def write_corpus(store, n, directory, seed=0):
+    path = os.path.join(directory, f"synthetic_{n}.csv")
+    synthetic_frame(store, n, seed).to_csv(path, index=False)
+    return path
+
+
+# ---------------------------------------------------------
+# 데이터 계층
+# ---------------------------------------------------------
+def bench_search(index):
+    """SearchIndex / FormulaDB 를 통합 검색 화면이 쓰는 limit 으로 잰다: 첫 쪽(PAGE_SIZE)과 마지막 쪽(SEARCH_RESULT_LIMIT)
+
+    질의 점수 캐시를 매번 비워 처음 검색하는 경우를 잰다.
+    """
+    def search(q, limit):
+        index._candidates.cache_clear()
+        return index.search(q, limit=limit)
+
+    return {
+        q: {"results": index.count(q),  # 0 이면 빈 결과를 재고 있는 것
+            "first_page_ms": timed(search, q, app.PAGE_SIZE, repeat=QUERY_REPEAT)[1],
+            "last_page_ms": timed(search, q, app.SEARCH_RESULT_LIMIT, repeat=QUERY_REPEAT)[1]}
+        for q in SEARCH_QUERIES
+    }
+
+
+def bench_data(csv_path, db_path, rng, repeat=3):
+    result = {}
+    parsed_csv, result["load_parse_csv_ms"] = timed(lambda: app._parse_frame(app.csv_frame(csv_path)), repeat=repeat)
+    parsed_book, result["load_parse_book_ms"] = timed(lambda: app._parse_frame(app.book_frame()), repeat=repeat)
+    store, result["merge_ms"] = timed(app.FormulaStore.merge, [parsed_book, parsed_csv], version="bench",
+                                      repeat=repeat)
+    result["n_formulas"] = len(store)
+    result["n_herb_rows"] = len(store.herbs)
+    result["memory_mb"] = round(
+        (store.formulas.memory_usage(deep=True).sum() + store.herbs.memory_usage(deep=True).sum()) / 2 ** 20, 2)
+
+    herb_index, result["herb_index_build_ms"] = timed(app.HerbIndex, store, repeat=repeat)
+    _, result["herb_query_ms"] = timed(herb_index.query, ["계지", "작약"], ["마황"], repeat=QUERY_REPEAT)
+
+    search_index, result["search_index_build_ms"] = timed(app.SearchIndex, store, repeat=repeat)
+    result["search_ms"] = bench_search(search_index)
+
+    engine, result["similarity_build_ms"] = timed(app.SimilarityEngine, store, repeat=repeat)
+    sample = rng.integers(0, len(store), size=20)
+    for metric in app.SIMILARITY_METRICS:
+        result[f"similarity_{metric}_row_ms"] = statistics.median(
+            timed(engine._compute, metric, np.array([i]), repeat=repeat)[1] for i in sample)
+
+    checker, result["checker_build_ms"] = timed(app.IncompatibilityChecker.from_store, store, repeat=repeat)
+    _, result["checker_check_ms"] = timed(checker.check, sample[:3].tolist(), repeat=QUERY_REPEAT)
+    orders = pd.DataFrame({
+        "rx_no": rng.integers(0, max(1, len(store) // 2), size=len(store)),
+        "formula_id": rng.integers(0, len(store), size=len(store)),
+        "cheop": rng.integers(1, 20, size=len(store)),
+    })
+    _, result["checker_screen_ms"] = timed(checker.screen, orders, repeat=repeat)
+    _, result["dose_batch_ms"] = timed(lambda: app.batch_totals(app.prescription_doses(store, orders, "sum")),
+                                       repeat=repeat)
+
+    # 컴파일은 이웃 목록 전체 계산을 포함해 큰 코퍼스에서 수 분이 걸리므로 한 번만 잰다
+    _, result["compile_db_ms"] = timed(app.compile_db, db_path, store)
+    db, result["db_open_ms"] = timed(app.FormulaDB, db_path, version="bench", repeat=repeat)
+    result["db_search_ms"] = bench_search(db)
+    return result
+
+
+# ---------------------------------------------------------
+# 앱 (AppTest)
+# ---------------------------------------------------------
+def _set_env(csv_path, db_path):
+    for key, value in (("HANBANG_FORMULAS_CSV", csv_path), ("HANBANG_DB", db_path)):
+        if value:
+            os.environ[key] = value
+        else:
+            os.environ.pop(key, None)
+
+
+@contextlib.contextmanager
+def shared_script_cache():
+    """AppTest 실행이 바이트코드 캐시 하나를 함께 쓰게 한다
+
+    AppTest 는 실행마다 ScriptCache 를 새로 만들어 app.py 를 매번 다시 컴파일한다 (이 머신에서 재실행마다
+    100ms 넘게 더해짐). 실제 서버는 한 번 컴파일한 바이트코드를 모든 재실행에 쓴다.
+    """
+    cache = ScriptCache()
+    modules = (app_test, local_script_runner)
+    originals = [module.ScriptCache for module in modules]
+    for module in modules:
+        module.ScriptCache = lambda: cache
+    try:
+        yield
+    finally:
+        for module, original in zip(modules, originals):
+            module.ScriptCache = original
+
+
+def bench_app(csv_path=None, db_path=None, timeout=300, repeat=3):
+    _set_env(csv_path, db_path)
+    try:
+        st.cache_resource.clear()
+        result = {"rerun_target_ms": app.LIST_RERUN_TARGET_MS}
+        with shared_script_cache():
+            result.update(_bench_clicks(timeout, repeat))
+    finally:
+        _set_env(None, None)
+
+    subs = [ms for c in result["clicks"].values() for ms in c["sub_cat_rerun_ms"].values()]
+    pages = [ms for c in result["clicks"].values() for ms in c["page_rerun_ms"].values()]
+    result["sub_cat_rerun_median_ms"] = statistics.median(subs)
+    result["sub_cat_rerun_max_ms"] = max(subs)
+    result["page_rerun_max_ms"] = max(pages, default=0.0)
+    result["max_sub_cat_pages"] = max(n for c in result["clicks"].values() for n in c["sub_cat_pages"].values())
+    result["within_target"] = max(subs + pages) <= app.LIST_RERUN_TARGET_MS
+    return result
+
+
+def _bench_clicks(timeout, repeat):
+    """대분류 -> 소분류 클릭, 여러 쪽인 소분류는 마지막 쪽으로 이동할 때의 재실행 시간"""
+    result = {}
+
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    _, result["cold_start_ms"] = timed(at.run)  # 캐시가 빈 첫 실행은 한 번뿐
+    _, result["first_render_ms"] = timed(
+        lambda: AppTest.from_file(APP_PATH, default_timeout=timeout).run(), repeat=repeat)
+
+    clicks = {}
+    for main_cat in at.radio[0].options:
+        at.radio[0].set_value(main_cat)
+        _, main_ms = timed(at.run, repeat=repeat)
+        subs, n_pages, pages = {}, {}, {}
+        for sub_cat in at.radio[1].options:
+            at.radio[1].set_value(sub_cat)
+            _, subs[sub_cat] = timed(at.run, repeat=repeat)
+            page_input = [w for w in at.number_input if w.key == f"page:{main_cat}/{sub_cat}"]
+            n_pages[sub_cat] = int(page_input[0].max) if page_input else 1
+            if page_input:
+                page_input[0].set_value(n_pages[sub_cat])
+                _, pages[sub_cat] = timed(at.run, repeat=repeat)
+        clicks[main_cat] = {"rerun_ms": main_ms, "sub_cat_rerun_ms": subs, "page_rerun_ms": pages,
+                            "sub_cat_pages": n_pages}
+    if len(at.exception):
+        raise RuntimeError(at.exception[0].message)
+    result["clicks"] = clicks
+    return result
+
+
+# ---------------------------------------------------------
+# 비교
+# ---------------------------------------------------------
+def flatten(data, prefix="", timing=False):
+    """시간 항목(키가 _ms 로 끝나거나 그 아래의 값)만 'a.b.c' 키로 펼친다"""
+    out = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        is_timing = timing or key.endswith("_ms")
+        if isinstance(value, dict):
+            out.update(flatten(value, name + ".", is_timing))
+        elif is_timing and isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[name] = value
+    return out
+
+
+def compare(current, baseline, tolerance, min_delta_ms=1.0):
+    """baseline 보다 tolerance 배 넘게, 그리고 min_delta_ms 이상 느려진 (항목, 이전, 현재) 목록"""
+    now, before = flatten(current), flatten(baseline)
+    return [(k, before[k], now[k]) for k in sorted(now.keys() & before.keys())
+            if before[k] > 0 and now[k] > before[k] * tolerance and now[k] - before[k] >= min_delta_ms]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="*", default=[1_000, 10_000, 100_000],
+                        help="데이터 계층을 잴 합성 코퍼스 크기")
+    parser.add_argument("--app-sizes", type=int, nargs="*", default=[10_000],
+                        help="앱 재실행 시간을 동봉 데이터에 더해 잴 합성 코퍼스 크기 (10k = 소분류마다 500개)")
+    parser.add_argument("--db", action="store_true", help="앱 측정을 SQLite 백엔드(HANBANG_DB)로도 반복")
+    parser.add_argument("--skip-app", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="bench_output.json")
+    parser.add_argument("--baseline", help="이전 결과 JSON - 느려진 항목이 있으면 종료 코드 1")
+    parser.add_argument("--tolerance", type=float, default=1.25)
+    parser.add_argument("--min-delta-ms", type=float, default=1.0, help="이보다 작은 차이는 느려짐으로 보지 않음")
+    parser.add_argument("--repeat", type=int, default=3, help="색인 생성·재실행 시간을 잴 반복 횟수 (중앙값)")
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    base_store = app.FormulaStore.merge(
+        [app._parse_frame(app.book_frame()), app._parse_frame(app.csv_frame(app.FORMULAS_CSV))], version="base")
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "streamlit": st.__version__,
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "seed": args.seed,
+            "repeat": args.repeat,
+        },
+        "data": {},
+        "app": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        corpora = {n: write_corpus(base_store, n, tmp, args.seed) for n in sorted(set(args.sizes + args.app_sizes))}
+        for n in args.sizes:
+            print(f"[data] {n:,}", file=sys.stderr)
+            report["data"][str(n)] = bench_data(corpora[n], os.path.join(tmp, f"synthetic_{n}.db"), rng, args.repeat)
+
+        if not args.skip_app:
+            runs = [("bundled", None)] + [(str(n), corpora[n]) for n in args.app_sizes]
+            for label, csv_path in runs:
+                print(f"[app] {label}", file=sys.stderr)
+                report["app"][label] = bench_app(csv_path, repeat=args.repeat)
+                if args.db:
+                    db_path = os.path.join(tmp, f"app_{label}.db")
+                    app.compile_db(db_path, app.FormulaStore.merge(
+                        [app._parse_frame(app.book_frame()),
+                         app._parse_frame(app.csv_frame(csv_path or app.FORMULAS_CSV))], version=label))
+                    report["app"][f"{label}+db"] = bench_app(csv_path, db_path, repeat=args.repeat)
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"-> {args.out}", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            slower = compare(report, json.load(f), args.tolerance, args.min_delta_ms)
+        for key, before, now in slower:
+            print(f"느려짐: {key} {before:.2f}ms -> {now:.2f}ms ({now / before:.2f}x)")
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
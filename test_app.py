@@ -0,0 +1,154 @@
+"""데이터 계층 회귀 테스트 (rx 파싱 · 합방 용량 · 처방 찾기 · 배합 금기)
+
+    python -m pytest -q
+"""
+import io
+import math
+import os
+
+import pandas as pd
+import pytest
+
+import app
+
+
+def make_store(*formulas):
+    """(처방명, rx) 목록 -> FormulaStore (출처·분류는 고정)"""
+    frame = pd.DataFrame(
+        [{"name": name, "abbr": "", "source": "TEST", "main_cat": "A", "sub_cat": "a", "rx": rx, "info": ""}
+         for name, rx in formulas],
+        columns=app.FORMULA_COLUMNS,
+    )
+    return app.FormulaStore.merge([app._parse_frame(frame)], version="test")
+
+
+@pytest.fixture(scope="module")
+def bundled_store():
+    """FORMULA_BOOK + 동봉 formulas.csv (HANBANG_FORMULAS_CSV 와 무관하게)"""
+    csv_path = os.path.join(app.BASE_DIR, "formulas.csv")
+    return app.FormulaStore.merge(
+        [app._parse_frame(app.book_frame()), app._parse_frame(app.csv_frame(csv_path))], version="test")
+
+
+# ---------------------------------------------------------
+# rx 파싱
+# ---------------------------------------------------------
+def test_explode_rx_units_and_aliases():
+    herbs = app.explode_rx(pd.Series(["마황 12g, 오미자 15알, 대추 2개, 감초 1.5g"], index=[7]))
+    assert herbs["id"].tolist() == [7, 7, 7, 7]
+    assert herbs["herb"].tolist() == ["마황", "오미자", "대조", "감초"]  # 대추 -> 대조
+    grams = herbs["grams"].tolist()
+    assert grams[0] == 12.0 and grams[3] == 1.5
+    assert math.isnan(grams[1]) and math.isnan(grams[2])  # 알 · 개 는 g 으로 환산하지 않는다
+
+
+def test_explode_rx_skips_empty_items():
+    herbs = app.explode_rx(pd.Series(["계지 8g, , 작약 8g,"]))
+    assert herbs["herb"].tolist() == ["계지", "작약"]
+
+
+# ---------------------------------------------------------
+# 합방 용량
+# ---------------------------------------------------------
+@pytest.fixture
+def combo_store():
+    return make_store(("가탕", "계지 8g, 작약 4g"), ("나탕", "계지 6g, 감초 2g, 대추 3개"))
+
+
+def doses_by_herb(store, orders, policy):
+    return app.prescription_doses(store, pd.DataFrame(orders), policy).set_index("herb")
+
+
+def test_combo_sum_adds_common_herbs(combo_store):
+    doses = doses_by_herb(combo_store, {"rx_no": [0, 0], "formula_id": [0, 1]}, "sum")
+    assert doses.loc["계지", "cheop_g"] == 14.0
+    assert doses.loc["작약", "cheop_g"] == 4.0
+    assert doses.loc["감초", "cheop_g"] == 2.0
+    assert math.isnan(doses.loc["대조", "cheop_g"])  # g 이외 단위만 있는 약재
+
+
+def test_combo_max_keeps_larger_dose(combo_store):
+    doses = doses_by_herb(combo_store, {"rx_no": [0, 0], "formula_id": [0, 1]}, "max")
+    assert doses.loc["계지", "cheop_g"] == 8.0
+    assert doses.loc["계지", "total_g"] == 8.0
+
+
+def test_combo_scales_each_row_before_aggregating(combo_store):
+    orders = {"rx_no": [0, 0], "formula_id": [0, 1], "cheop": [2, 6], "factor": [1.0, 0.5]}
+    summed = doses_by_herb(combo_store, orders, "sum")
+    assert summed.loc["계지", "total_g"] == 8.0 * 2 + 6.0 * 6 * 0.5
+    assert summed.loc["작약", "total_g"] == 4.0 * 2
+    largest = doses_by_herb(combo_store, orders, "max")
+    assert largest.loc["계지", "total_g"] == 6.0 * 6 * 0.5  # 1첩 용량은 가탕이 크지만 첩 수를 곱하면 나탕이 크다
+    assert largest.loc["계지", "cheop_g"] == 8.0
+
+
+def test_batch_totals_groups_prescriptions(combo_store):
+    orders = pd.DataFrame({"rx_no": [0, 1], "formula_id": [0, 1], "cheop": [1, 2]})
+    totals = app.batch_totals(app.prescription_doses(combo_store, orders))
+    assert totals.loc["계지", "total_g"] == 8.0 + 12.0
+    assert totals.loc["계지", "total_don"] == 20.0 / app.DON_G
+
+
+# ---------------------------------------------------------
+# 처방 찾기 (처방명 · 약어 · 출처)
+# ---------------------------------------------------------
+def test_resolve_by_abbreviation(bundled_store):
+    ids = bundled_store.resolve(pd.Series(["계", "없는처방"]))
+    assert ids.iloc[0] == 131
+    assert bundled_store.rows([131])[0]["abbr"] == "계"
+    assert math.isnan(ids.iloc[1])
+
+
+def test_resolve_by_source(bundled_store):
+    names = pd.Series(["계지탕", "계지탕"])
+    plain = bundled_store.resolve(names)
+    by_source = bundled_store.resolve(names, pd.Series(["JKMED", None]))
+    assert plain.tolist() == [1, 1]  # 대표 처방 = 의감중마
+    assert by_source.tolist() == [131, 1]
+    assert bundled_store.rows([131])[0]["source"] == "JKMED"
+
+
+def test_read_batch_orders_resolves_and_validates(bundled_store):
+    orders = app.read_batch_orders(bundled_store, io.StringIO("처방번호,처방명,출처,첩수\n1,계,,3\n2,계지탕,JKMED,\n"))
+    assert orders["formula_id"].tolist() == [131, 131]
+    assert orders["cheop"].iloc[0] == 3 and math.isnan(orders["cheop"].iloc[1])
+
+    with pytest.raises(ValueError, match="처방명"):
+        app.read_batch_orders(bundled_store, io.StringIO("처방번호,이름\n1,계지탕\n"))
+    with pytest.raises(ValueError, match="첩수"):
+        app.read_batch_orders(bundled_store, io.StringIO("처방번호,처방명,첩수\n1,계지탕,세 첩\n"))
+
+
+# ---------------------------------------------------------
+# 배합 금기
+# ---------------------------------------------------------
+def conflicts(warnings):
+    return {(kind, herbs) for kind, herbs in warnings if not kind.startswith("임신")}
+
+
+def test_eighteen_antagonisms_buja_banha():
+    checker = app.IncompatibilityChecker.from_store(make_store(("가탕", "부자 4g, 반하 8g")))
+    assert conflicts(checker.check([0])) == {("십팔반", "부자 ↔ 반하")}
+
+
+def test_eighteen_antagonisms_buja_gwarusil_across_formulas():
+    store = make_store(("가탕", "부자 4g, 생강 8g"), ("나탕", "과루실 12g"), ("다탕", "계지 8g"))
+    checker = app.IncompatibilityChecker.from_store(store)
+    assert conflicts(checker.check([0, 1])) == {("십팔반", "부자 ↔ 과루실")}
+    assert conflicts(checker.check([0, 2])) == set()
+
+
+def test_nineteen_fears_and_pregnancy():
+    checker = app.IncompatibilityChecker.from_store(make_store(("가탕", "인삼 4g, 오령지 4g, 도인 4g")))
+    warnings = checker.check([0])
+    assert ("십구외", "인삼 ↔ 오령지") in warnings
+    assert ("임신 신중", "도인") in warnings
+
+
+def test_screen_reports_per_prescription():
+    store = make_store(("가탕", "부자 4g"), ("나탕", "반하 8g"), ("다탕", "계지 8g"))
+    checker = app.IncompatibilityChecker.from_store(store)
+    report = checker.screen(pd.DataFrame({"rx_no": ["A", "A", "B"], "formula_id": [0, 1, 2]}))
+    assert set(report.loc[report["kind"] == "십팔반", "rx_no"]) == {"A"}
+    assert "B" not in set(report["rx_no"])